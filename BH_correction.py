@@ -1,7 +1,7 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 
 """
-Python 2.7 code for performing a Benjamini-Hochberg procedure to correct for
+Python 3 code for performing a Benjamini-Hochberg procedure to correct for
 multiple-testing false discovery rate.
 
 Required input:
@@ -82,13 +82,13 @@ if __name__ == '__main__':
 
     if discovery:
         stranded_expts = pval_list[:largest_k]
-        print 'BH correction complete!  Largest k is {}'.format(largest_k)
-        print 'Stranded experiments are these:'
-        print stranded_expts
+        print('BH correction complete!  Largest k is {}'.format(largest_k))
+        print('Stranded experiments are these:')
+        print(stranded_expts)
 
         stranded_file_path = os.path.join(out_path, 'stranded_SRAs.txt')
         with open(stranded_file_path, 'w') as stranded_file:
             for set in stranded_expts:
                 stranded_file.write('{},{}\n'.format(set[0], set[1]))
     else:
-        print 'BH correction complete! All experiments were unstranded.'
+        print('BH correction complete! All experiments were unstranded.')
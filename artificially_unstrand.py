@@ -1,7 +1,7 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 
 """
-Python 2.7 code to make a stranded fastq file randomly, artificially unstranded
+Python 3 code to make a stranded fastq file randomly, artificially unstranded
 
 Required input:
     .fastq file: stranded
@@ -13,19 +13,161 @@ Optional input:
 """
 
 import argparse
+from itertools import islice
 import mmh3
+import numpy as np
 import os
-import random
-import string
+import sys
+
+
+_COMPLEMENT = bytes.maketrans(b"ATCGNatcgn", b"TAGCNtagcn")
+_READ_BUFFER = 1 << 20
+_WRITE_BUFFER = 1 << 20
+_BATCH_RECORDS = 1 << 14
 
 
 def reverse_complement(dna_sequence):
-    complement = string.maketrans("ATCG", "TAGC")
-    rev_comp = dna_sequence.translate(complement)[::-1]
-    return rev_comp
+    """Returns the reverse complement of one sequence, without a newline.
+
+    The batched flipping in unstrand_batch does not call this; it is the
+    record-at-a-time reference that the unit tests check it against.
+    """
+    return dna_sequence.translate(_COMPLEMENT)[::-1]
+
+
+def fastq_batches(fastq):
+    """Yields lists of lines from an open fastq file, whole records at a time.
+
+    Each list holds up to _BATCH_RECORDS 4-line records as bytes, with the
+    newlines still attached, so sequence lines are lines[1::4] and quality
+    lines are lines[3::4], and records that are not flipped can be written
+    verbatim.
+    """
+    while True:
+        lines = list(islice(fastq, 4 * _BATCH_RECORDS))
+        if not lines:
+            return
+        if not lines[-1].endswith(b'\n'):
+            lines[-1] += b'\n'
+        yield lines
+
+
+def _reverse_block(block):
+    """Reverses each line of a block of newline-terminated lines.
+
+    Reversing the whole block in one slice also reverses the line order, so
+    the lines are split back out and returned in their original order.
+    """
+    if not block:
+        return []
+    return (block[-2::-1] + b'\n').splitlines(True)[::-1]
+
+
+def reverse_batch(lines):
+    """Returns each of a list of newline-ended lines reversed."""
+    return _reverse_block(b''.join(lines))
+
+
+def reverse_complement_batch(sequences):
+    """Returns the reverse complements of a list of newline-ended sequences.
+
+    The whole batch is joined so that one translate and one reversed slice
+    cover every sequence, rather than two calls per read.  This is
+    reverse_batch with the complement lookup added.
+    """
+    return _reverse_block(b''.join(sequences).translate(_COMPLEMENT))
+
+
+def flip_indices(rng, num_records):
+    """Picks which records in a batch to flip to the other strand.
+
+    One vectorized draw from rng, a numpy Generator, makes a coin flip for
+    every record in the batch; the indices of the heads are returned.
+    """
+    return np.flatnonzero(rng.integers(0, 2, num_records))
+
+
+def unstrand_batch(lines, flipped):
+    """Flips the records at the given indices of a batch of fastq lines.
+
+    Sequence lines are reverse complemented and quality lines reversed to
+    match, in place; the name and plus lines are unchanged.  flipped must be
+    sorted, as flip_indices returns it.
+
+    The flipped sequence and quality lines are each flipped as one joined
+    byte string, so a batch takes a few C-level calls rather than two per
+    read.
+    """
+    if not len(flipped):
+        return
+    num_records = len(lines) // 4
+    if flipped[-1] >= num_records:
+        raise ValueError('Record {} flipped in a batch of {} records'.format(
+            flipped[-1], num_records))
+    rows = [4 * i + 1 for i in flipped]
+    sequences = reverse_complement_batch([lines[row] for row in rows])
+    qualities = reverse_batch([lines[row + 2] for row in rows])
+    for row, sequence, quality in zip(rows, sequences, qualities):
+        lines[row] = sequence
+        lines[row + 2] = quality
+
+
+def _advise(open_file, *advice):
+    """Passes posix_fadvise hints for a whole open file, where supported.
+
+    The hints are only advisory, so platforms without posix_fadvise and
+    files that cannot take them, such as pipes, are left as they are.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for name in advice:
+        try:
+            os.posix_fadvise(open_file.fileno(), 0, 0, getattr(os, name))
+        except OSError:
+            return
 
 
-if __name__ == '__main__':
+def unstrand_fastqs(fastq_files, shuffled_files, seed):
+    """Randomly flips reads of fastq files to the other strand.
+
+    Input:
+        fastq_files: list of fastq paths; one for single-end experiments, or
+            the two mate files of a paired-end experiment
+        shuffled_files: list of output paths, one per input file
+        seed: integer seed for the coin flips, e.g. mmh3.hash of the sample
+            name; only its low 32 bits are used
+
+    All the files are read a batch at a time in lockstep and share one set of
+    coin flips, so both mates of a pair are always flipped together.  If the
+    mate files differ in length, output stops at the end of the shorter one.
+    Flips come from a counter-based Philox generator seeded with seed, drawn
+    a batch at a time, so a given seed and batch size always flip the same
+    reads.  Files are read and written as bytes.
+
+    The inputs are read front to back, so the kernel is told to read ahead
+    aggressively.  Inputs and outputs both stay in the page cache, since
+    download_and_quantify_fastqs.py runs Salmon on each of them straight
+    afterwards.
+    """
+    rng = np.random.Generator(np.random.Philox(seed & 0xFFFFFFFF))
+    fastqs = [open(path, 'rb', _READ_BUFFER) for path in fastq_files]
+    out_fastqs = [open(path, 'wb', _WRITE_BUFFER) for path in shuffled_files]
+    try:
+        for fastq in fastqs:
+            _advise(fastq, 'POSIX_FADV_SEQUENTIAL')
+        for batches in zip(*[fastq_batches(fastq) for fastq in fastqs]):
+            num_lines = min(map(len, batches))
+            batches = [lines[:num_lines] for lines in batches]
+            flipped = flip_indices(rng, num_lines // 4)
+            for lines, out_fastq in zip(batches, out_fastqs):
+                unstrand_batch(lines, flipped)
+                out_fastq.write(b''.join(lines))
+    finally:
+        for open_file in fastqs + out_fastqs:
+            open_file.close()
+
+
+if __name__ == '__main__' and '--test' not in sys.argv:
     parser = argparse.ArgumentParser(description='Determine sample '
                                                  'strandedness.')
     parser.add_argument('--fastq-file', '-f', required=True, help='Stranded '
@@ -36,6 +178,9 @@ if __name__ == '__main__':
                         'paired end reads here.')
     parser.add_argument('--output-directory', '-o', default='./',
                         help='Desired path for storing output FASTA files.')
+    parser.add_argument('--test', action='store_const', const=True,
+                        default=False,
+                        help='run unit tests and exit')
 
     args = parser.parse_args()
     fastq_file_1 = args.fastq_file
@@ -44,48 +189,120 @@ if __name__ == '__main__':
 
     name_tag = os.path.basename(fastq_file_1).split('.')[0]
     seed = mmh3.hash(name_tag)
-    random.seed(seed)
-    line_number = 0
-    coinflip = random.randint(0, 1)
 
     if fastq_file_2:
         shuffled_fastq1 = os.path.join(out_path,
                                        '{}_shuffled_1.fastq'.format(name_tag))
         shuffled_fastq2 = os.path.join(out_path,
                                        '{}_shuffled_2.fastq'.format(name_tag))
-        with open(fastq_file_1) as fastq1, \
-             open(fastq_file_2) as fastq2,\
-             open(shuffled_fastq1, 'w') as out_fastq_1, \
-             open(shuffled_fastq2, 'w') as out_fastq_2:
-            for line1, line2 in zip(fastq1, fastq2):
-                line_number += 1
-                line1 = line1.strip('\n')
-                line2 = line2.strip('\n')
-                if line_number == 5:
-                    line_number = 1
-                    coinflip = random.randint(0, 1)
-                if line_number == 2 and coinflip:
-                    line1 = reverse_complement(line1)
-                    line2 = reverse_complement(line2)
-                if line_number == 4 and coinflip:
-                    line1 = line1[::-1]
-                    line2 = line2[::-1]
-                print >>out_fastq_1, '{}'.format(line1)
-                print >>out_fastq_2, '{}'.format(line2)
+        unstrand_fastqs([fastq_file_1, fastq_file_2],
+                        [shuffled_fastq1, shuffled_fastq2], seed)
 
     else:
         shuffled_fastq = os.path.join(out_path,
                                       '{}_shuffled.fastq'.format(name_tag))
-        with open(fastq_file_1) as fastq, \
-             open(shuffled_fastq, 'w') as out_fastq:
-            for line in fastq:
-                line_number += 1
-                line = line.strip('\n')
-                if line_number == 5:
-                    line_number = 1
-                    coinflip = random.randint(0, 1)
-                if line_number == 2 and coinflip:
-                    line = reverse_complement(line)
-                if line_number == 4 and coinflip:
-                    line = line[::-1]
-                print >>out_fastq, '{}'.format(line)
+        unstrand_fastqs([fastq_file_1], [shuffled_fastq], seed)
+
+elif __name__ == '__main__':
+    # Test units
+    del sys.argv[1:] # Don't choke on extra command-line parameters
+    import io
+    import random
+    import tempfile
+    import unittest
+
+    def make_records(lengths, seed=0):
+        """ Returns fastq lines with one record per read length given. """
+        rng = random.Random(seed)
+        lines = []
+        for i, length in enumerate(lengths):
+            sequence = bytes(rng.choice(b'ACGTNacgtn') for _ in range(length))
+            quality = bytes(rng.randint(33, 74) for _ in range(length))
+            lines += [b'@read%d\n' % i, sequence + b'\n', b'+\n',
+                      quality + b'\n']
+        return lines
+
+    def flip_records(lines, flipped):
+        """ Flips records one at a time, as the reference for the batches. """
+        lines = list(lines)
+        for i in flipped:
+            sequence = lines[4 * i + 1][:-1]
+            lines[4 * i + 1] = reverse_complement(sequence) + b'\n'
+            lines[4 * i + 3] = lines[4 * i + 3][-2::-1] + b'\n'
+        return lines
+
+    class TestUnstrandBatch(unittest.TestCase):
+        """ Tests unstrand_batch() against flipping record by record. """
+
+        def assertFlips(self, lines, flipped):
+            """ Fails if the batch differs from flipping each record. """
+            batch = list(lines)
+            unstrand_batch(batch, np.array(flipped, dtype=np.int64))
+            self.assertEqual(batch, flip_records(lines, flipped))
+
+        def test_fixed_length_reads(self):
+            """ Fails if same-length reads flip wrongly. """
+            lines = make_records([50] * 20)
+            self.assertFlips(lines, [0, 3, 4, 11, 19])
+            self.assertFlips(lines, list(range(20)))
+
+        def test_varying_length_reads(self):
+            """ Fails if varying-length reads flip wrongly. """
+            lines = make_records([1, 2, 3, 50, 0, 75, 1, 150])
+            self.assertFlips(lines, [0, 1, 2, 4, 7])
+            self.assertFlips(lines, list(range(8)))
+
+        def test_no_flips(self):
+            """ Fails if a batch without flips is changed. """
+            lines = make_records([10, 20])
+            self.assertFlips(lines, [])
+
+        def test_flip_past_batch(self):
+            """ Fails if a flip past the end of the batch is not refused. """
+            lines = make_records([10] * 4)
+            with self.assertRaises(ValueError):
+                unstrand_batch(lines, np.array([4], dtype=np.int64))
+
+        def test_final_line_without_newline(self):
+            """ Fails if a missing final newline is not restored. """
+            lines = make_records([10, 12])
+            batches = list(fastq_batches(io.BytesIO(b''.join(lines)[:-1])))
+            self.assertEqual(batches, [lines])
+
+    class TestUnstrandFastqs(unittest.TestCase):
+        """ Tests unstrand_fastqs() on mate files. """
+
+        def setUp(self):
+            self.directory = tempfile.TemporaryDirectory()
+
+        def write_fastq(self, name, lines):
+            path = os.path.join(self.directory.name, name)
+            with open(path, 'wb') as fastq:
+                fastq.write(b''.join(lines))
+            return path
+
+        def read_fastq(self, path):
+            with open(path, 'rb') as fastq:
+                return fastq.readlines()
+
+        def test_mismatched_mates(self):
+            """ Fails unless mates flip together and stop at the shorter. """
+            mates_1 = make_records([40] * 20, seed=1)
+            mates_2 = make_records([30, 31, 32] * 4, seed=2)
+            fastq_files = [self.write_fastq('in_1.fastq', mates_1),
+                           self.write_fastq('in_2.fastq', mates_2)]
+            shuffled_files = [os.path.join(self.directory.name, name)
+                              for name in ('out_1.fastq', 'out_2.fastq')]
+            unstrand_fastqs(fastq_files, shuffled_files, 1234)
+
+            rng = np.random.Generator(np.random.Philox(1234))
+            flipped = flip_indices(rng, 12)
+            self.assertEqual(self.read_fastq(shuffled_files[0]),
+                             flip_records(mates_1[:48], flipped))
+            self.assertEqual(self.read_fastq(shuffled_files[1]),
+                             flip_records(mates_2, flipped))
+
+        def tearDown(self):
+            self.directory.cleanup()
+
+    unittest.main()
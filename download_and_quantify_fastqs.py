@@ -1,7 +1,7 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 
 """
-Python 2.7 code for processing randomly sampled "stranded"-called experiments.
+Python 3 code for processing randomly sampled "stranded"-called experiments.
 
 Required input:
     .txt file of called "stranded" experiment accession numbers generated by
@@ -17,13 +17,17 @@ quantification with Salmon.
 
 
 import argparse
+from artificially_unstrand import unstrand_fastqs
 from datetime import datetime
 import logging
 import mmh3
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import os
+import queue
 import random
-import string
 import subprocess as sp
+import threading
 from time import sleep
 
 
@@ -37,81 +41,145 @@ def sample_stranded_experiments(sra_containing_file, sample_size):
         sample_size: the number of sra numbers to randomly collect
 
     Returns a list of random SRA accession numbers previously classified as
-    stranded.
+    stranded.  The file is streamed once through a reservoir sample, so only
+    sample_size accessions are ever held in memory; the same file name still
+    always gives the same sample, though not the one random.sample gave.
     """
     name_tag = os.path.basename(sra_containing_file)
     seed = mmh3.hash(name_tag)
     random.seed(seed)
-    with open(sra_containing_file) as sra_file:
-        lines = random.sample(sra_file.readlines(), sample_size)
-
     accession_numbers = []
-    for line in lines:
-        accession_numbers.append(line.split(',')[0])
+    with open(sra_containing_file) as sra_file:
+        for line_number, line in enumerate(sra_file):
+            if line_number < sample_size:
+                accession_numbers.append(line.split(',')[0])
+            else:
+                index = random.randint(0, line_number)
+                if index < sample_size:
+                    accession_numbers[index] = line.split(',')[0]
+    if len(accession_numbers) < sample_size:
+        raise ValueError('Sample larger than the {} accessions in {}'.format(
+            len(accession_numbers), sra_containing_file))
     return accession_numbers
 
 
-def collect_fastq_files(fastq_path, accs, fail_file, success_file):
-    """Downloads fastq reads and returns their directory
+def download_fastq(fastq_path, acc, fastq_output, fail_file, success_file,
+                   file_lock, downloaded=None):
+    """Downloads the fastq reads for one accession number, retrying on failure
 
     Input:
         fastq_path: the path to fastq-dump (string)
-        accs: list of SRA accession numbers to download (list of strings)
-        output: the output path for writing out (string)
+        acc: the SRA accession number to download (string)
+        fastq_output: the directory in which to store the fastq files (string)
         fail_file: the file to which to write any failed accession numbers for
             re-running later. (string)
-
-    Returns the path where the new fastq files are stored.
+        success_file: the file to which to write downloaded accession numbers
+            (string)
+        file_lock: lock shared by all download threads, held while appending
+            to fail_file or success_file (threading.Lock)
+        downloaded: optional queue on which to put acc once it is downloaded
+
+    Retries fastq-dump with exponential back-off until it succeeds or the time
+    limit passes, in which case TimeOut is raised.
     """
-    existing_fastqs = []
-    with open(success_file, 'r') as success:
-        for line in success:
-            existing_fastqs.append(line.strip('\n'))
-            
-    # downloaded_accs 
     max_time = 3000
-    dl_start = datetime.now()
-    fastq_output = os.path.join(out_path, 'original_fastq_files')
     back_off = 3
-    bad_accs = ['SRR5575952', 'SRR2960573', 'ERR1837056']
-    for acc in accs:
-        # logging.info('current acc is {}'.format(acc))
-        if acc in existing_fastqs or acc in bad_accs:
-            logging.info('skipping acc {}'.format(acc))
-            continue
-        logging.info('\ncollecting fastq {}'.format(acc))
-        bin_time = 0
-        bin_start = datetime.now()
-        delay = 1
-        attempt = 1
-        while bin_time <= max_time:
-            try:
-                fastq_stdout = sp.check_output(['{}'.format(fastq_path), '-I',
-                                                '-B', '-W', '-E',
-                                                '--split-files',
-                                                '--skip-technical', '-O',
-                                                fastq_output, acc])
-                logging.info('fastq-dump was successful; std output was:')
-                logging.info(fastq_stdout)
+    logging.info('\ncollecting fastq {}'.format(acc))
+    bin_time = 0
+    bin_start = datetime.now()
+    delay = 1
+    attempt = 1
+    while bin_time <= max_time:
+        try:
+            fastq_stdout = sp.check_output([fastq_path, '-I',
+                                            '-B', '-W', '-E',
+                                            '--split-files',
+                                            '--skip-technical', '-O',
+                                            fastq_output, acc],
+                                           universal_newlines=True)
+            logging.info('fastq-dump was successful for {}; std output '
+                         'was:'.format(acc))
+            logging.info(fastq_stdout)
+            with file_lock:
                 with open(success_file, 'a') as success:
                     success.write('{}\n'.format(acc))
-                break
-            except:
-                logging.info('acc {} failed: attempt {}'.format(acc, attempt))
-                delay = delay * back_off
-                logging.info('waiting {} sec before retry'.format(delay))
-                sleep(delay)
-                attempt += 1
-                bin_time = (datetime.now() - bin_start).total_seconds()
-        else:
-            logging.info('Accession number {} download timed out.  Moving '
-                         'on to the next accession number.\n'.format(acc))
+            if downloaded is not None:
+                downloaded.put(acc)
+            break
+        except:
+            logging.info('acc {} failed: attempt {}'.format(acc, attempt))
+            delay = delay * back_off
+            logging.info('waiting {} sec before retry'.format(delay))
+            sleep(delay)
+            attempt += 1
+            bin_time = (datetime.now() - bin_start).total_seconds()
+    else:
+        logging.info('Accession number {} download timed out.  Moving '
+                     'on to the next accession number.\n'.format(acc))
+        with file_lock:
             with open(fail_file, 'a') as failed:
                 failed.write('{}\n'.format(acc))
-            raise TimeOut('This SRA accession number download has timed '
-                          'out.  See the standard output for the '
-                          'fastq-dump error messages.  Moving on to the '
-                          'next accession number.\n')
+        raise TimeOut('This SRA accession number download has timed '
+                      'out.  See the standard output for the '
+                      'fastq-dump error messages.  Moving on to the '
+                      'next accession number.\n')
+
+
+def collect_fastq_files(fastq_path, accs, output, fail_file, success_file,
+                        workers=8, downloaded=None):
+    """Downloads fastq reads and returns their directory
+
+    Input:
+        fastq_path: the path to fastq-dump (string)
+        accs: list of SRA accession numbers to download (list of strings)
+        output: the output path for writing out (string)
+        fail_file: the file to which to write any failed accession numbers for
+            re-running later. (string)
+        workers: the number of fastq-dump downloads to run at once (int)
+        downloaded: optional queue on which each accession number is put as
+            soon as its fastq files are on disk, including ones downloaded by
+            an earlier run, followed by None once all downloads are over
+
+    Downloads are network-bound, so they run concurrently in a thread pool,
+    each with its own retry loop.  If any accession times out, TimeOut is
+    raised once the other downloads have finished.
+
+    Returns the path where the new fastq files are stored.
+    """
+    try:
+        existing_fastqs = []
+        with open(success_file, 'r') as success:
+            for line in success:
+                existing_fastqs.append(line.strip('\n'))
+
+        dl_start = datetime.now()
+        fastq_output = os.path.join(output, 'original_fastq_files')
+        bad_accs = ['SRR5575952', 'SRR2960573', 'ERR1837056']
+        to_download = []
+        for acc in accs:
+            if acc in existing_fastqs or acc in bad_accs:
+                logging.info('skipping acc {}'.format(acc))
+                if acc in existing_fastqs and downloaded is not None:
+                    downloaded.put(acc)
+                continue
+            to_download.append(acc)
+
+        file_lock = threading.Lock()
+        pool = ThreadPool(workers)
+        try:
+            results = [pool.apply_async(download_fastq,
+                                        (fastq_path, acc, fastq_output,
+                                         fail_file, success_file, file_lock,
+                                         downloaded))
+                       for acc in to_download]
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        if downloaded is not None:
+            downloaded.put(None)
+    for result in results:
+        result.get()
 
     dl_end = datetime.now()
     time_difference = dl_end - dl_start
@@ -120,17 +188,21 @@ def collect_fastq_files(fastq_path, accs, fail_file, success_file):
     return fastq_output
 
 
-def reverse_complement(dna_sequence):
-    """Creates and returns the reverse complement of a nucleotide sequence
+def run_capturing_errors(errors, target, *args):
+    """Runs target(*args), keeping any exception it raises
 
     Input:
-        dna_sequence: the nucleotide sequence to reverse complement
+        errors: list to which an exception raised by target is appended
+        target: the function to run, usually as a thread's target
+        args: the arguments to pass to target
 
-    Returns: the sequence's reverse complement
+    Lets the main thread re-raise an exception from a worker thread once it
+    has joined it, instead of the thread only printing a traceback.
     """
-    complement = string.maketrans("ATCG", "TAGC")
-    rev_comp = dna_sequence.translate(complement)[::-1]
-    return rev_comp
+    try:
+        target(*args)
+    except BaseException as error:
+        errors.append(error)
 
 
 def artificially_unstrand(accession, fastq_path):
@@ -149,9 +221,6 @@ def artificially_unstrand(accession, fastq_path):
     """
     # name_tag = os.path.basename(fastq_file_1).split('.')[0].split('_')[0]
     seed = mmh3.hash(accession)
-    random.seed(seed)
-    line_number = 0
-    coinflip = random.randint(0, 1)
 
     fastq_file_1 = os.path.join(fastq_path, '{}_1.fastq'.format(accession))
     fastq_file_2 = os.path.join(fastq_path, '{}_2.fastq'.format(accession))
@@ -162,46 +231,44 @@ def artificially_unstrand(accession, fastq_path):
                                        '{}_shuffled_1.fastq'.format(accession))
         shuffled_fastq2 = os.path.join(fastq_path   ,
                                        '{}_shuffled_2.fastq'.format(accession))
-        with open(fastq_file_1) as fastq1, \
-             open(fastq_file_2) as fastq2,\
-             open(shuffled_fastq1, 'w') as out_fastq_1, \
-             open(shuffled_fastq2, 'w') as out_fastq_2:
-            for line1, line2 in zip(fastq1, fastq2):
-                line_number += 1
-                line1 = line1.strip('\n')
-                line2 = line2.strip('\n')
-                if line_number == 5:
-                    line_number = 1
-                    coinflip = random.randint(0, 1)
-                if line_number == 2 and coinflip:
-                    line1 = reverse_complement(line1)
-                    line2 = reverse_complement(line2)
-                if line_number == 4 and coinflip:
-                    line1 = line1[::-1]
-                    line2 = line2[::-1]
-                print >>out_fastq_1, '{}'.format(line1)
-                print >>out_fastq_2, '{}'.format(line2)
+        unstrand_fastqs([fastq_file_1, fastq_file_2],
+                        [shuffled_fastq1, shuffled_fastq2], seed)
 
     else:
         paired = False
         shuffled_fastq = os.path.join(fastq_path,
                                       '{}_shuffled_1.fastq'.format(accession))
-        with open(fastq_file_1) as fastq, \
-             open(shuffled_fastq, 'w') as out_fastq:
-            for line in fastq:
-                line_number += 1
-                line = line.strip('\n')
-                if line_number == 5:
-                    line_number = 1
-                    coinflip = random.randint(0, 1)
-                if line_number == 2 and coinflip:
-                    line = reverse_complement(line)
-                if line_number == 4 and coinflip:
-                    line = line[::-1]
-                print >>out_fastq, '{}'.format(line)
+        unstrand_fastqs([fastq_file_1], [shuffled_fastq], seed)
     return paired
 
 
+def unstrand_all(downloaded, fastq_path, unstranded, quantified):
+    """Artificially unstrands the fastq files of each accession in turn
+
+    Input:
+        downloaded: queue of SRA accession numbers whose fastq files are ready
+            to unstrand, ended by None
+        fastq_path: path for fastq file storage
+        unstranded: queue on which (accession, paired) is put as each
+            accession is finished, followed by None after the last one
+        quantified: accession numbers already quantified, which are skipped
+
+    Meant to run on its own thread, so that accessions are unstranded as soon
+    as they are downloaded, while their fastq files are likely still in the
+    page cache, and while Salmon quantifies earlier ones.
+    """
+    try:
+        for acc in iter(downloaded.get, None):
+            if acc in quantified:
+                logging.info('acc {} already quantified; '
+                             'skipping'.format(acc))
+                continue
+            paired = artificially_unstrand(acc, fastq_path)
+            unstranded.put((acc, paired))
+    finally:
+        unstranded.put(None)
+
+
 def call_salmon_quantification(salmon_path, salmon_ind, outpath, acc, paired):
     """Runs salmon in quantification mode
     Input:
@@ -212,51 +279,64 @@ def call_salmon_quantification(salmon_path, salmon_ind, outpath, acc, paired):
         acc: the base name of the fastq files to quantify
         paired: whether or not the experiment is paired end
 
-    Runs Salmon quantification, and stores results in a directory specific to
-    the accession number of the experiment.
+    Runs Salmon quantification of the original and the unstranded reads at
+    the same time, each with half of the available cores, and stores results
+    in a directory specific to the accession number of the experiment.
     """
     logging.info('starting quantification for {} reads'.format(acc))
+    threads = max(1, cpu_count() // 2)
     quant_start = datetime.now()
     orig_out = os.path.join(outpath, 'salmon_output_{}_original'.format(acc))
     shuf_out = os.path.join(outpath, 'salmon_output_{}_unstranded'.format(acc))
+    fq_orig_1 = os.path.join(fastq_path, '{}_1.fastq'.format(acc))
+    fq_shuf_1 = os.path.join(fastq_path, '{}_shuffled_1.fastq'.format(acc))
 
     if paired:
-        fq_orig_1 = os.path.join(fastq_path, '{}_1.fastq'.format(acc))
         fq_orig_2 = os.path.join(fastq_path, '{}_2.fastq'.format(acc))
         salmon_command_orig = ('set -exo pipefail; {sal} quant -i {ref} -l A '
-                               '-1 {f} -2 {s} -o {out} --posBias --gcBias'
+                               '-1 {f} -2 {s} -o {out} --posBias --gcBias '
+                               '-p {p}'
                                ).format(sal=salmon_path, ref=salmon_ind,
                                         f=fq_orig_1, s=fq_orig_2,
-                                        out=orig_out)
+                                        out=orig_out, p=threads)
 
-        fq_shuf_1 = os.path.join(fastq_path, '{}_shuffled_1.fastq'.format(acc))
         fq_shuf_2 = os.path.join(fastq_path, '{}_shuffled_2.fastq'.format(acc))
         salmon_command_shuf = ('set -exo pipefail; {sal} quant -i {ref} -l A '
-                               '-1 {f} -2 {s} -o {out} --posBias --gcBias'
+                               '-1 {f} -2 {s} -o {out} --posBias --gcBias '
+                               '-p {p}'
                                ).format(sal=salmon_path, ref=salmon_ind,
                                         f=fq_shuf_1, s=fq_shuf_2,
-                                        out=shuf_out)
+                                        out=shuf_out, p=threads)
     else:
-        fq_orig_1 = os.path.join(fastq_path, '{}_1.fastq'.format(acc))
         salmon_command_orig = ('set -exo pipefail; {sal} quant -i {ref} -l A '
-                               '-r {r} -o {out} --posBias --gcBias'
+                               '-r {r} -o {out} --posBias --gcBias -p {p}'
                                ).format(sal=salmon_path, ref=salmon_ind,
-                                        r=fq_orig_1, out=orig_out)
-        fq_shuf_1 = os.path.join(fastq_path, '{}_shuffled_1.fastq'.format(acc))
+                                        r=fq_orig_1, out=orig_out, p=threads)
         salmon_command_shuf = ('set -exo pipefail; {sal} quant -i {ref} -l A '
-                               '-r {r} -o {out} --posBias --gcBias'
+                               '-r {r} -o {out} --posBias --gcBias -p {p}'
                                ).format(sal=salmon_path, ref=salmon_ind,
-                                        r=fq_shuf_1, out=shuf_out)
+                                        r=fq_shuf_1, out=shuf_out, p=threads)
 
     salmon_process_orig = sp.Popen(salmon_command_orig, stdin=sp.PIPE,
                                    stderr=sp.PIPE, shell=True,
-                                   executable='/bin/bash')
-    salmon_process_orig.communicate()
-
+                                   executable='/bin/bash',
+                                   universal_newlines=True)
     salmon_process_shuf = sp.Popen(salmon_command_shuf, stdin=sp.PIPE,
                                    stderr=sp.PIPE, shell=True,
-                                   executable='/bin/bash')
-    salmon_process_shuf.communicate()
+                                   executable='/bin/bash',
+                                   universal_newlines=True)
+    # Drain both stderr pipes at once so neither run stalls on a full pipe
+    salmon_processes = [salmon_process_orig, salmon_process_shuf]
+    pool = ThreadPool(len(salmon_processes))
+    salmon_errors = pool.map(lambda process: process.communicate()[1],
+                             salmon_processes)
+    pool.close()
+    for process, out, errors in zip(salmon_processes, [orig_out, shuf_out],
+                                    salmon_errors):
+        if process.returncode:
+            logging.info('salmon quantification into {} failed; std error '
+                         'was:'.format(out))
+            logging.info(errors)
 
     quant_end = datetime.now()
     time_difference = quant_end - quant_start
@@ -292,6 +372,9 @@ if __name__ == '__main__':
                         ' with already-downloaded sra accession numbers.')
     parser.add_argument('--quantified-sras', '-qs', help='Give the path to '
                         'file with already-quantified sra accession numbers.')
+    parser.add_argument('--download-workers', '-w', type=int, default=8,
+                        help='Give the number of fastq files to download at '
+                        'once.')
 
     args = parser.parse_args()
     sra_file = args.stranded_list
@@ -303,6 +386,7 @@ if __name__ == '__main__':
     log_mode = args.log_level
     success_file = args.downloaded_sras
     quantify_file = args.quantified_sras
+    download_workers = args.download_workers
 
     name_tag = os.path.basename(sra_file).split('.')[0]
     now = str(datetime.now())
@@ -316,20 +400,39 @@ if __name__ == '__main__':
     pv_weigh = os.path.join(out_path, 'weighted_pvals_{}.txt'.format(name_tag))
 
     accession_numbers = sample_stranded_experiments(sra_file, sample_size)
-    print('starting collection of fastq files')
-    fastq_path = collect_fastq_files(fastq_dump, accession_numbers, fail_file,
-                                     success_file)
-
     with open(quantify_file, 'r') as q_record:
         quantified_fastqs = []
         for line in q_record:
             quantified_fastqs.append(line.strip('\n'))
-    for acc in accession_numbers:
-        if acc in quantified_fastqs:
-            logging.info('acc {} already quantified; skipping'.format(acc))
-            continue
-        paired = artificially_unstrand(acc, fastq_path)
+
+    print('starting collection of fastq files')
+    fastq_path = os.path.join(out_path, 'original_fastq_files')
+    downloaded = queue.Queue()
+    collect_errors = []
+    collector = threading.Thread(target=run_capturing_errors,
+                                 args=(collect_errors, collect_fastq_files,
+                                       fastq_dump, accession_numbers,
+                                       out_path, fail_file, success_file,
+                                       download_workers, downloaded))
+    collector.daemon = True
+    collector.start()
+
+    unstranded = queue.Queue(maxsize=2)
+    unstrand_errors = []
+    unstrander = threading.Thread(target=run_capturing_errors,
+                                  args=(unstrand_errors, unstrand_all,
+                                        downloaded, fastq_path, unstranded,
+                                        quantified_fastqs))
+    unstrander.daemon = True
+    unstrander.start()
+    for acc, paired in iter(unstranded.get, None):
         call_salmon_quantification(salmon, salmon_index, out_path, acc,
                                    paired)
         with open(quantify_file, 'a') as success:
             success.write('{}\n'.format(acc))
+    unstrander.join()
+    if unstrand_errors:
+        raise unstrand_errors[0]
+    collector.join()
+    if collect_errors:
+        raise collect_errors[0]
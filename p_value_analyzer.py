@@ -1,7 +1,7 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 
 """
-Python 2.7 code for performing a Benjamini-Hochberg procedure to correct for
+Python 3 code for performing a Benjamini-Hochberg procedure to correct for
 multiple-testing false discovery rate.
 Required input:
     File containing SRA (or other experiment ID numbers) and their p-values
@@ -1,7 +1,7 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 
 """
-Python 2.7 code for collecting p-values for strandedness of RNA-seq experiments
+Python 3 code for collecting p-values for strandedness of RNA-seq experiments
 
 Required input:
     .csv File from SRA with SRA accession numbers to check.
@@ -17,6 +17,7 @@ Optional input:
     Max attmpts: how many times to try fastq-dump read download, and hisat2
         read alignment, before moving on to the next set of downloads or the
         next SRA accession number.
+    Workers: how many SRA accession numbers to process at once.
     Logging level: INFO is the only option supported right now.
 
 Improvements to be made:
@@ -25,26 +26,70 @@ Improvements to be made:
 
 import argparse
 import csv
+from concurrent.futures import as_completed, ProcessPoolExecutor
 from datetime import datetime
-import gzip
+from functools import partial
 from itertools import groupby
 import logging
 import mmh3
+from multiprocessing.pool import ThreadPool
+import numpy as np
 from operator import itemgetter
 import os
 import random
 import re
 import subprocess as sp
 from scipy import stats
-from time import sleep
 import sys
+import threading
+
+
+_ALIGNMENT_SCORE = re.compile(r'\tAS:i:([+-]?\d+)')
 
 
 class TimeOut(Exception): pass
 
 
+def dump_spots(fastq_path, acc, start_spot, stop_spot, timed_out,
+               max_time=300):
+    """Downloads one range of spots with fastq-dump, retrying on failure.
+
+    Input:
+        fastq_path: the path to fastq-dump (string)
+        acc: the SRA accession number to download from (string)
+        start_spot: the first spot to download (int)
+        stop_spot: the last spot to download (int)
+        timed_out: threading.Event shared by all of the accession's bins; set
+            when this bin gives up, and checked before every attempt so that
+            the other bins give up too
+        max_time: seconds to keep retrying before giving up (int)
+
+    Returns the spots as interleaved fastq text, or None if every attempt
+    failed for max_time seconds or another bin has already timed out.
+    """
+    bin_start = datetime.now()
+    delay = 1
+    attempt = 1
+    back_off = 3
+    while (not timed_out.is_set() and
+           (datetime.now() - bin_start).total_seconds() <= max_time):
+        try:
+            return sp.check_output([fastq_path, '-I', '-B', '-W', '-E',
+                                    '--split-spot', '--skip-technical', '-N',
+                                    str(start_spot), '-X', str(stop_spot),
+                                    '-Z', acc], universal_newlines=True)
+        except:
+            logging.info('acc {} failed: attempt {}'.format(acc, attempt))
+            delay = delay * back_off
+            logging.info('waiting {} sec before retry'.format(delay))
+            timed_out.wait(delay)
+            attempt += 1
+    timed_out.set()
+    return None
+
+
 def get_hisat_input(required, multiplier, total, fastq_path, acc, output,
-                    pairedtag, fail_file):
+                    pairedtag, fail_file, rng, dump_workers=4):
     """Samples & downloads fastq reads, and prepares them for a hisat2 -12 run.
 
     Input:
@@ -61,9 +106,12 @@ def get_hisat_input(required, multiplier, total, fastq_path, acc, output,
             processing multiple reads per spot (true/false)
         fail_file: the file to which to write any failed accession numbers for
             re-running later.
+        rng: the random.Random instance to draw the sampled spots from
+        dump_workers: how many fastq-dump downloads to run at once (int)
 
     A list of unique random numbers between 1 and the total number of spots is
-    generated, then the reads at those spots are downloaded with fastq-dump.
+    generated, then the reads at those spots are downloaded with fastq-dump,
+    several bins at a time.
     Each downloaded read is then formated appropriately for hisat2 with the -12
     option, which requires the following form: one read or read pair per line,
     tab separated as follows: read name, read 1 alignment, read 1 quality
@@ -71,113 +119,104 @@ def get_hisat_input(required, multiplier, total, fastq_path, acc, output,
 
     Writes a file, SRAx_spots.txt, with the sampled spots used to get data.
 
-    Returns all of the sampled reads formatted for batch alignment by hisat2,
-    and the list of random spots (to be saved for later reference).
+    Returns a list of all of the sampled reads, each a line formatted for
+    batch alignment by hisat2.
     """
-    max_time = 300
     dl_start = datetime.now()
     spot_path = os.path.join(output, '{}_spots.txt'.format(acc))
+    required_spots = required * multiplier
+    num_bins = 100
+#     num_bins = 10
+    bin_spots = required_spots // num_bins
+    bin_size = total // num_bins
+    bin = 1
+    spot_ranges = []
+    while bin <= num_bins:
+        bin_start = (bin - 1) * bin_size + 1
+        bin_stop = bin * bin_size
+        bin += 1
+        start_spot = rng.randint(bin_start, bin_stop - bin_spots)
+        spot_ranges.append((start_spot, start_spot + bin_spots))
     with open(spot_path, 'w') as spot_file:
-        required_spots = required * multiplier
-        num_bins = 100
-#         num_bins = 10
-        bin_spots = required_spots/num_bins
-        bin_size = total/num_bins
-        bin = 1
-        read_format = []
-        while bin <= num_bins:
-            bin_start = (bin - 1) * bin_size + 1
-            bin_stop = bin * bin_size
-            bin += 1
-            start_spot = random.randint(bin_start, bin_stop - bin_spots)
-            spot_file.write('{}\n'.format(start_spot))
-            spot = str(start_spot)
-            stop_spot = str(start_spot + bin_spots)
-            bin_time = 0
-            bin_start = datetime.now()
-            delay = 1
-            attempt = 1
-            back_off = 3
-            while bin_time <= max_time:
-                try:
-                    fastq = sp.check_output(['{}'.format(fastq_path), '-I',
-                                             '-B', '-W', '-E', '--split-spot',
-                                             '--skip-technical', '-N', spot,
-                                             '-X', stop_spot, '-Z', acc])
-                    break
-                except:
-                    logging.info('acc {} failed: attempt {}'.format(acc,
-                                                                    attempt))
-                    delay = delay * back_off
-                    logging.info('waiting {} sec before retry'.format(delay))
-                    sleep(delay)
-                    attempt += 1
-                    bin_time = (datetime.now() - bin_start).total_seconds()
-            else:
-                logging.info('Accession number {} download timed out.  Moving '
-                             'on to the next accession number.\n'.format(acc))
-                with open(fail_file, 'w') as failed:
-                    failed.write('{}\n'.format(acc))
-                raise TimeOut('This SRA accession number download has timed '
-                              'out.  See the standard output for the '
-                              'fastq-dump error messages.  Moving on to the '
-                              'next accession number.')
-
-            lines = fastq.split('\n')
-            format_lines = []
-            last_line = 4 * (pairedtag + 1)
-            for i, line in enumerate(lines, 1):
-                if i % 2 == 0:
-                    format_lines += [line]
-                elif (i - 1) % last_line == 0:
-                    format_lines += [line]
-                if i % last_line == 0:
-                    read_format.extend(['\t'.join(format_lines) + '\n'])
-                    format_lines = []
-        read_input = ''.join(read_format)
-        hisat_formatted_input = read_input
-        dl_end = datetime.now()
-        time_difference = dl_end - dl_start
-        elapsed_time = time_difference.total_seconds()
-        logging.info('total download time was {} seconds'.format(elapsed_time))
-        return hisat_formatted_input
-
-
-def align_reads(hisat2_path, reference_genome, outpath, acc, reads):
-    """Returns SAM format reads aligned by hisat2.
+        spot_file.write(''.join('{}\n'.format(start_spot)
+                                for start_spot, stop_spot in spot_ranges))
+
+    timed_out = threading.Event()
+    pool = ThreadPool(dump_workers)
+    try:
+        fastqs = pool.starmap(partial(dump_spots, fastq_path, acc,
+                                      timed_out=timed_out), spot_ranges)
+    finally:
+        pool.close()
+    if None in fastqs:
+        logging.info('Accession number {} download timed out.  Moving '
+                     'on to the next accession number.\n'.format(acc))
+        with open(fail_file, 'w') as failed:
+            failed.write('{}\n'.format(acc))
+        raise TimeOut('This SRA accession number download has timed '
+                      'out.  See the standard output for the '
+                      'fastq-dump error messages.  Moving on to the '
+                      'next accession number.')
+
+    # Each spot is 4 fastq lines per read; keep the first name line, and the
+    # sequence and quality lines of each read
+    last_line = 4 * (pairedtag + 1)
+    columns = (0, 1, 3, 5, 7) if pairedtag else (0, 1, 3)
+    read_format = []
+    for fastq in fastqs:
+        lines = fastq.split('\n')
+        spots = zip(*[lines[column::last_line] for column in columns])
+        read_format.extend('\t'.join(spot) + '\n' for spot in spots)
+    dl_end = datetime.now()
+    time_difference = dl_end - dl_start
+    elapsed_time = time_difference.total_seconds()
+    logging.info('total download time was {} seconds'.format(elapsed_time))
+    return read_format
+
+
+def _feed_reads(pipe, reads):
+    """Writes reads to a subprocess's stdin, then closes it."""
+    try:
+        pipe.writelines(reads)
+        pipe.close()
+    except BrokenPipeError:
+        pass
+
+
+def align_reads(hisat2_path, reference_genome, reads):
+    """Starts hisat2 aligning reads, with its SAM output left on a pipe.
     Input:
         hisat2_path: the path to hisat2 (string)
         reference_genome: the path to the reference genome to be used for
             alignment (string)
         reads: fastq reads correctly formatted for the hisat2 -12 option
-            (string, one read per line tab separated, name seq qual if
-            single-end or name seq qual seq qual if paired-end)
-        temp_dir: dir in which to put temporary fastq
-
-    Returns a list of aligned reads in SAM format.
-    """
-    align_start = datetime.now()
-    reads_path = os.path.join(outpath, '{}_reads.sam.gz'.format(acc))
-    align_command = ('set -exo pipefail; {h2} --no-head --12 - -x {ref} | gzip'
-                     ' > {file}').format(h2=hisat2_path, ref=reference_genome,
-                                         file=reads_path)
-    align_process = sp.Popen(align_command, stdin=sp.PIPE, stderr=sp.PIPE,
-                             shell=True, executable='/bin/bash')
-    align_process.communicate(input=reads)
-
-    align_end = datetime.now()
-    time_difference = align_end - align_start
-    elapsed_time = time_difference.total_seconds()
-    logging.info('total alignment time was {}'.format(elapsed_time))
-    return reads_path, align_process.returncode
+            (list of strings, one read per line tab separated, name seq qual
+            if single-end or name seq qual seq qual if paired-end)
 
+    The reads are fed to hisat2 from a separate thread, so its stdout can be
+    consumed as it is produced rather than written to disk and read back.
 
-def filter_alignments(alignments, paired_tag):
+    Returns the running hisat2 process; iterate over its stdout for the
+    aligned reads in SAM format, then wait() on it for the return code.
+    """
+    align_process = sp.Popen([hisat2_path, '--no-head', '--12', '-', '-x',
+                              reference_genome], stdin=sp.PIPE,
+                             stdout=sp.PIPE, stderr=sp.DEVNULL,
+                             universal_newlines=True)
+    feeder = threading.Thread(target=_feed_reads,
+                              args=(align_process.stdin, reads))
+    feeder.daemon = True
+    feeder.start()
+    return align_process
+
+
+def filter_alignments(alignments, paired_tag, rng):
     """Returns only alignments with highest alignment scores.
 
     Input:
-        alignment_list: list of all returned alignments for one read or pair.
+        alignments: list of all returned alignments for one read or pair.
         paired_tag: whether the experiment is paired end or single end.
+        rng: the random.Random instance to choose first or second reads with.
 
     Checks each alignment for AS:i: tag, then filters the list by highest
     possible AS:i: value for the group of alignments.
@@ -188,53 +227,57 @@ def filter_alignments(alignments, paired_tag):
     all reads here will be paired-end, and that therefore, any read that does
     not have flag & 64 must have flag & 128, i.e. be a second read.)
 
-    Returns a list of alignments with the highest alignment scores, either
-    first or second read only if paired end.
+    Each alignment is parsed once, here, for its score, SAM flag and XS:A:
+    strand, so callers need not look at the SAM line again.
+
+    Returns a list of (SAM flag, fwd_gene) pairs for the alignments with the
+    highest alignment scores, either first or second read only if paired
+    end; fwd_gene is whether the XS:A: tag is +, or None if there is none.
     """
-    # results = re.findall('(^.*AS:i:([+-]?\d+).*$)', '\n'.join(alignment_list),
-    #                      flags=re.M)
-    # if not results:
-    #     return 0
-    # max_score = max(results, key=itemgetter(1))[1]
-    # alignments = filter(lambda item: item[1] == max_score, results)
-    # primary_alignments = [item[0] for item in alignments]
-    # return primary_alignments
-    alignment_scores = []
+    parsed_alignments = []
     for entry in alignments:
-        for tag in entry.split('\t'):
-            if tag[:5] == 'AS:i:':
-                alignment_scores.extend([int(tag[5:])])
-    if not alignment_scores:
-        return 0
-    max_alignment_score = max(alignment_scores)
-    primary_alignments = [alignments[i] for i, alignment_score
-                          in enumerate(alignment_scores)
+        alignment_score = _ALIGNMENT_SCORE.search(entry)
+        if alignment_score is None:
+            continue
+        if 'XS:A:+' in entry:
+            fwd_gene = True
+        elif 'XS:A:-' in entry:
+            fwd_gene = False
+        else:
+            fwd_gene = None
+        parsed_alignments.append((int(alignment_score.group(1)),
+                                  int(entry.split('\t', 2)[1]), fwd_gene))
+    if not parsed_alignments:
+        return []
+    max_alignment_score = max(alignment_score for alignment_score, flag,
+                              fwd_gene in parsed_alignments)
+    primary_alignments = [(flag, fwd_gene) for alignment_score, flag, fwd_gene
+                          in parsed_alignments
                           if alignment_score == max_alignment_score]
 
     if paired_tag:
-        first_reads = random.getrandbits(1)
+        first_reads = rng.getrandbits(1)
         single_end = []
-        for entry in primary_alignments:
-            read = entry.split('\t')
-            flag = int(read[1])
+        for flag, fwd_gene in primary_alignments:
             if not flag & 1:
                 break
             if first_reads == (flag & 64 == 64):
-                single_end.extend([entry])
+                single_end.append((flag, fwd_gene))
         prepared_alignments = single_end
     else:
         prepared_alignments = primary_alignments
     return prepared_alignments
 
 
-def read_sense(SAM_flag, plus_or_minus):
+def read_sense(SAM_flag, fwd_gene):
     """Checks a read's SAM flag and XS:A: tag, and determines its "direction".
 
     "Read sense" is terminology we introduce that is true (or "+") if
     alignment orientation agrees with the sense strand as reported in the
     XS:A flag.
 
-    Input the SAM flag (int) and XS:A:? tag (string) from the aligned read.
+    Input the SAM flag (int) from the aligned read, and whether its XS:A: tag
+    is + (bool).
 
     We have two states, arbitrarily called "sense" and "antisense," indicating
     whether all the first/second reads align with a gene or with its reverse
@@ -243,13 +286,163 @@ def read_sense(SAM_flag, plus_or_minus):
     Return the read's "sense"ness - if bit = 1, the read is "sense", otherwise
     it is "antisense."
     """
-    fwd_gene = plus_or_minus[0] == 'XS:A:+'
     paired = SAM_flag & 1 == 1
     rev_read = SAM_flag & 16 == 16
     first_read = SAM_flag & 64 == 64
     return (fwd_gene != rev_read) == (first_read or not paired)
 
 
+_SENSE_FLAGS = 1 | 16 | 64
+_SENSE_TABLE = np.array([read_sense(index & _SENSE_FLAGS, index >> 7 == 1)
+                         for index in range(256)], dtype=np.bool_)
+
+
+def read_senses(SAM_flags, fwd_genes):
+    """Determines the "direction" of many reads at once, as read_sense does.
+
+    Input:
+        SAM_flags: the reads' SAM flags (sequence of ints)
+        fwd_genes: whether each read's XS:A: tag is + (sequence of bools)
+
+    Only the paired, reverse and first-read bits of the flag matter, so
+    together with the strand they index _SENSE_TABLE, read_sense evaluated
+    once for every combination at import.
+
+    Returns a numpy bool array, true where the read is "sense".
+    """
+    SAM_flags = np.asarray(SAM_flags, dtype=np.int64)
+    fwd_genes = np.asarray(fwd_genes, dtype=np.int64)
+    return _SENSE_TABLE[(SAM_flags & _SENSE_FLAGS) | (fwd_genes << 7)]
+
+
+def count_read_senses(aligned_reads, paired, rng):
+    """Tallies sense reads over SAM alignments grouped by read name.
+
+    Input:
+        aligned_reads: iterable of SAM lines with each read's alignments
+            adjacent, as hisat2 writes them
+        paired: whether the experiment is paired end or single end
+        rng: the random.Random instance to draw alignments with
+
+    Each read's best alignments are found with filter_alignments.  One of
+    them, drawn at random, counts towards the random tally, and each counts
+    towards the weighted tally with weight 1 / (number of best alignments).
+    Only alignments with an XS:A: strand tag are counted.
+
+    The flags and strands of the counted alignments are collected over the
+    whole run and their senses found in one vectorized read_senses call, as
+    groups are mostly too small to be worth an array each.  The weights are
+    summed in alignment order with plain floats, so the weighted tallies,
+    and the p-values truncated from them, match the old running totals.
+
+    Returns random sense reads, random reads checked, weighted sense reads
+    and weighted reads checked.
+    """
+    flags = []
+    fwd_genes = []
+    weights = []
+    drawn = []
+    sort_by_names = lambda x: x.partition('\t')[0]
+    for key, group in groupby(aligned_reads, sort_by_names):
+        alignments = list(group)
+        primary_alignments = filter_alignments(alignments, paired, rng)
+        if not primary_alignments:
+            continue
+
+        num_primaries = float(len(primary_alignments))
+        weight = 1 / num_primaries
+        rng.shuffle(primary_alignments)
+        one_read = False
+        for flag, fwd_gene in primary_alignments:
+            if fwd_gene is None:
+                continue
+            flags.append(flag)
+            fwd_genes.append(fwd_gene)
+            weights.append(weight)
+            drawn.append(not one_read)
+            one_read = True
+
+    senses = read_senses(flags, fwd_genes)
+    drawn = np.array(drawn, dtype=np.bool_)
+    random_sense = int(np.count_nonzero(senses & drawn))
+    random_checked = int(np.count_nonzero(drawn))
+    weighted_sense = sum(
+        weight for weight, sense in zip(weights, senses) if sense)
+    weighted_checked = sum(weights)
+    return random_sense, random_checked, weighted_sense, weighted_checked
+
+
+def strand_p_value(sense, checked):
+    """Returns the p-value of a read sense count under no strand bias.
+
+    Input:
+        sense: the number of sense reads (int, or float if weighted)
+        checked: the number of reads checked (int, or float if weighted)
+
+    This is a 2-sided & symmetrical binomial test at p = 0.5: same result
+    whether sense or antisense is used.  Weighted counts are truncated to
+    whole reads, as the old stats.binom_test did, and with no reads checked
+    the p-value is 1.
+    """
+    sense = int(sense)
+    checked = int(checked)
+    if not checked:
+        return 1.0
+    return stats.binomtest(sense, checked, 0.5).pvalue
+
+
+def process_accession(sra_acc, num_spots, paired, required, multiplier,
+                      fastq_path, hisat2_path, reference_genome, output,
+                      max_attempts, fail_file):
+    """Samples, aligns and tallies the read senses of one SRA accession.
+
+    Input:
+        sra_acc: the SRA accession number to process (string)
+        num_spots: the total number of spots in the experiment (int)
+        paired: whether the experiment is paired end or single end
+        required, multiplier, fastq_path, output, fail_file: as for
+            get_hisat_input
+        hisat2_path, reference_genome: as for align_reads
+        max_attempts: how many times to try hisat2 alignment (int)
+
+    All random draws come from one random.Random seeded from the accession
+    number, so each accession samples the same spots and draws the same
+    alignments whichever worker runs it, and whatever else that worker ran.
+
+    Returns the four tallies from count_read_senses, or None if the download
+    timed out or every alignment attempt failed.
+    """
+    seed = mmh3.hash(sra_acc)
+    rng = random.Random(seed)
+    logging.info('the random seed for {} is {}'.format(sra_acc, seed))
+
+    try:
+        hisat_input = get_hisat_input(required, multiplier, num_spots,
+                                      fastq_path, sra_acc, output, paired,
+                                      fail_file, rng)
+    except TimeOut:
+        return None
+
+    attempt = 0
+    random_state = rng.getstate()
+    while attempt < max_attempts:
+        rng.setstate(random_state)
+        align_start = datetime.now()
+        align_process = align_reads(hisat2_path, reference_genome,
+                                    hisat_input)
+        with align_process.stdout as aligned_reads:
+            counts = count_read_senses(aligned_reads, paired, rng)
+        failure = align_process.wait()
+        align_time = datetime.now() - align_start
+        logging.info('total alignment time was {}'.format(
+            align_time.total_seconds()))
+        attempt += 1
+        if not failure:
+            return counts
+    logging.info('alignment failed for SRA {}'.format(sra_acc))
+    return None
+
+
 if __name__ == '__main__' and '--test' not in sys.argv:
     parser = argparse.ArgumentParser(description='Determine sample '
                                                  'strandedness.')
@@ -263,8 +456,8 @@ if __name__ == '__main__' and '--test' not in sys.argv:
     parser.add_argument('--hisat-path', '-p', default='hisat2',
                         help='specify the path for hisat2')
     parser.add_argument('--output-path', '-o', default='./', help='give path '
-                        'for output files: sampled spots, aligned junction '
-                        'reads, and SRA numbers with their p-values.')
+                        'for output files: sampled spots and SRA numbers '
+                        'with their p-values.')
     parser.add_argument('--required-reads', '-n', type=int, default=100,
                         help='give the target number of useful reads.')
     parser.add_argument('--multiplier', '-m', type=int, default=10, help='a '
@@ -275,6 +468,10 @@ if __name__ == '__main__' and '--test' not in sys.argv:
                         ' number of times to attempt hisat2 alignment one one '
                         'SRA accession number after alingment failure before '
                         'continuing.')
+    parser.add_argument('--workers', '-w', type=int, default=4, help='the '
+                        'number of SRA accession numbers to download and '
+                        'align at once; each runs its own hisat2, with its '
+                        'own copy of the index in memory.')
     parser.add_argument('--log-level', '-l', choices=['DEBUG', 'INFO', 'ERROR'
                                                       'WARNING', 'CRITICAL'],
                         default='INFO', help='choose what logging mode to run')
@@ -292,9 +489,9 @@ if __name__ == '__main__' and '--test' not in sys.argv:
     read_multiplier = args.multiplier
     max_attempts = args.max_attempts
     log_mode = args.log_level
+    workers = args.workers
 
     minimum_spots = 10000000
-    useful = True
     name_tag = os.path.basename(sra_file).split('.')[0]
     now = str(datetime.now())
     log_file = os.path.join(out_path, '{}_{}_log.txt'.format(name_tag, now))
@@ -303,93 +500,66 @@ if __name__ == '__main__' and '--test' not in sys.argv:
     pv_rand = os.path.join(out_path, 'random_pvals_{}.txt'.format(name_tag))
     pv_weigh = os.path.join(out_path, 'weighted_pvals_{}.txt'.format(name_tag))
     with open(sra_file) as sra_array, \
-         open(pv_rand, 'w', 0) as pval_rand_file,\
-         open (pv_weigh, 'w', 0) as pval_weigh_file:
-        sra_array.next()
+         open(pv_rand, 'w', 1) as pval_rand_file,\
+         open (pv_weigh, 'w', 1) as pval_weigh_file:
+        next(sra_array)
         csv_reader = csv.reader(sra_array)
-        for experiment in csv_reader:
-            sra_acc, num_spots, paired = (experiment[0], int(experiment[3]),
-                                          experiment[15] == 'PAIRED')
-
-            # to filter out single cell reads
-            if num_spots < minimum_spots:
-                logging.info('SRA {} skipped due to too few spots\n'
-                             ''.format(sra_acc))
-                continue
-
-            seed = mmh3.hash(sra_acc)
-            random.seed(seed)
-            logging.info('the random seed is {}'.format(seed))
-
-            try:
-                hisat_input = get_hisat_input(required_reads, read_multiplier,
-                                              num_spots, fastq_dump, sra_acc,
-                                              out_path, paired, fail_file)
-            except TimeOut:
-                continue
-
-            attempt = 0
-            while attempt < max_attempts:
-                reads_path, failure = align_reads(hisat2, ref_genome, out_path,
-                                                  sra_acc, hisat_input)
-                attempt += 1
-                if not failure:
-                    break
-            else:
-                logging.info('alignment failed for SRA {}'.format(sra_acc))
-                continue
-
-            random_sense = 0
-            random_checked = 0
-            weighted_sense = 0
-            weighted_checked = 0
-            with gzip.open('{}'.format(reads_path), 'r') as aligned_reads:
-                sort_by_names = lambda x: x.split('\t')[0]
-                for key, group in groupby(aligned_reads, sort_by_names):
-                    alignments = list(group)
-                    primary_alignments = filter_alignments(alignments, paired)
-                    if not primary_alignments:
-                        continue
-
-                    num_primaries = float(len(primary_alignments))
-                    weight = 1 / num_primaries
-                    random.shuffle(primary_alignments)
-                    one_read = not useful
-                    for entry in primary_alignments:
-                        read = entry.split('\t')
-                        flag = int(read[1])
-                        XS_A = re.findall('XS:A:[+-]', entry)
-                        if XS_A:
-                            weighted_sense += read_sense(flag, XS_A) * weight
-                            weighted_checked += weight
-                            if not one_read == useful:
-                                random_sense += read_sense(flag, XS_A)
-                                random_checked += 1
-                                one_read = useful
-
-            # stats.binom_test is a 2-sided & symmetrical cdf calculation:
-            # same result whether sense or antisense is used
-            r = 0.5
-            random_anti = random_checked - random_sense
-            random_p = stats.binom_test(random_sense, random_checked, r)
-            weighted_anti = weighted_checked - weighted_sense
-            weighted_p = stats.binom_test(weighted_sense, weighted_checked, r)
-
-            logging.info('The SRA accession number is {}'.format(sra_acc))
-            logging.info('pval file record is {}'.format(name_tag))
-            logging.info('Drawing one random primary alignment, there are:')
-            logging.info('{} sense reads.'.format(random_sense))
-            logging.info('{} antisense reads.'.format(random_anti))
-            logging.info('{} junction reads.'.format(random_checked))
-            logging.info('The random p-value is {}'.format(random_p))
-            logging.info('Looking at all primary alignments, there are:')
-            logging.info('{} weighted sense reads.'.format(weighted_sense))
-            logging.info('{} weighted antisense reads.'.format(weighted_anti))
-            logging.info('The weighted p-value is {}.\n'.format(weighted_p))
-
-            print >>pval_rand_file, '{},{}'.format(sra_acc, random_p)
-            print >>pval_weigh_file, '{},{}'.format(sra_acc, weighted_p)
-            # pval_file.write('{},{}\n'.format(sra_acc, p_value))
+        process = partial(process_accession, required=required_reads,
+                          multiplier=read_multiplier, fastq_path=fastq_dump,
+                          hisat2_path=hisat2, reference_genome=ref_genome,
+                          output=out_path, max_attempts=max_attempts,
+                          fail_file=fail_file)
+        # Workers log to the same file whether they are forked or spawned
+        log_setup = partial(logging.basicConfig, filename=log_file,
+                            level=log_mode)
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=log_setup) as executor:
+            futures = {}
+            for experiment in csv_reader:
+                sra_acc, num_spots, paired = (experiment[0],
+                                              int(experiment[3]),
+                                              experiment[15] == 'PAIRED')
+
+                # to filter out single cell reads
+                if num_spots < minimum_spots:
+                    logging.info('SRA {} skipped due to too few spots\n'
+                                 ''.format(sra_acc))
+                    continue
+
+                future = executor.submit(process, sra_acc, num_spots, paired)
+                futures[future] = sra_acc
+
+            for future in as_completed(futures):
+                sra_acc = futures[future]
+                counts = future.result()
+                if counts is None:
+                    continue
+                (random_sense, random_checked, weighted_sense,
+                 weighted_checked) = counts
+
+                random_anti = random_checked - random_sense
+                random_p = strand_p_value(random_sense, random_checked)
+                weighted_anti = weighted_checked - weighted_sense
+                weighted_p = strand_p_value(weighted_sense, weighted_checked)
+
+                logging.info('The SRA accession number is {}'.format(sra_acc))
+                logging.info('pval file record is {}'.format(name_tag))
+                logging.info('Drawing one random primary alignment, there '
+                             'are:')
+                logging.info('{} sense reads.'.format(random_sense))
+                logging.info('{} antisense reads.'.format(random_anti))
+                logging.info('{} junction reads.'.format(random_checked))
+                logging.info('The random p-value is {}'.format(random_p))
+                logging.info('Looking at all primary alignments, there are:')
+                logging.info('{} weighted sense reads.'.format(weighted_sense))
+                logging.info('{} weighted antisense reads.'.format(
+                    weighted_anti))
+                logging.info('The weighted p-value is {}.\n'.format(
+                    weighted_p))
+
+                pval_rand_file.write('{},{}\n'.format(sra_acc, random_p))
+                pval_weigh_file.write('{},{}\n'.format(sra_acc, weighted_p))
+                # pval_file.write('{},{}\n'.format(sra_acc, p_value))
 
 elif __name__ == '__main__':
     # Test units
@@ -404,21 +574,48 @@ elif __name__ == '__main__':
 
         def test_minus_strand_examples(self):
             """ Fails if read sense is incorrect for single-end alignments. """
-            self.assertEqual(read_sense(16, ['XS:A:-']), True)
-            self.assertEqual(read_sense(0, ['XS:A:-']), False)
+            self.assertEqual(read_sense(16, False), True)
+            self.assertEqual(read_sense(0, False), False)
 
         def test_plus_strand_examples(self):
             """ Fails if read sense is incorrect for single-end alignments. """
-            self.assertEqual(read_sense(16, ['XS:A:+']), False)
-            self.assertEqual(read_sense(0, ['XS:A:+']), True)
+            self.assertEqual(read_sense(16, True), False)
+            self.assertEqual(read_sense(0, True), True)
 
         def test_plus_strand_paired_end_example(self):
             """ Fails if read sense is incorrect for paired-end alignments. """
             # 147 = 1 (multisegments) + 2 (each segment mapped) +
             # 128 (second segment in template) + 16 (reverse complemented)
-            self.assertEqual(read_sense(147, ['XS:A:+']), True)
+            self.assertEqual(read_sense(147, True), True)
+
+        def test_vectorized_agrees(self):
+            """ Fails if read_senses and read_sense ever disagree. """
+            flags = list(range(256)) * 2
+            fwd_genes = [True] * 256 + [False] * 256
+            expected = [read_sense(flag, fwd)
+                        for flag, fwd in zip(flags, fwd_genes)]
+            self.assertEqual(read_senses(flags, fwd_genes).tolist(), expected)
 
         def tearDown(self):
             pass
 
+    class TestFilterAlignments(unittest.TestCase):
+        """ Tests filter_alignments(). """
+
+        def test_alignment_without_score(self):
+            """ Fails if an unscored alignment shifts the scores. """
+            # 69 = unmapped first mate with no AS:i: tag; 137 and 393 are
+            # the mapped second mate, primary and secondary
+            alignments = ['r1\t69\tchr1\t100\t0\t*\t=\t100\t0\tACGT\tIIII'
+                          '\tYT:Z:UP\n',
+                          'r1\t137\tchr1\t100\t60\t4M\t=\t100\t0\tACGT\t'
+                          'IIII\tAS:i:-5\tXS:A:-\n',
+                          'r1\t393\tchr2\t200\t1\t4M\t=\t200\t0\tACGT\t'
+                          'IIII\tAS:i:0\tXS:A:+\n']
+            self.assertEqual(filter_alignments(alignments, False,
+                                               random.Random(0)),
+                             [(393, True)])
+            self.assertEqual(filter_alignments(alignments[:1], False,
+                                               random.Random(0)), [])
+
     unittest.main()